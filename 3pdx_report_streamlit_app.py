@@ -6,32 +6,36 @@
 - 재현성 있는 포맷과 그래프 삽입 지원
 """
 
+import io
 import os
 import re
+import tempfile
+import asyncio
+import hashlib
+import importlib.metadata
+import importlib.util
+import platform
 import streamlit as st
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
+from types import MappingProxyType
 import time
-from typing import List, Optional, Any, Dict, TYPE_CHECKING
+from dataclasses import dataclass, asdict
+from typing import List, Optional, Any, Dict, Iterator, Tuple, TYPE_CHECKING
 import json
 
 # 타입 체킹을 위한 조건부 임포트
 if TYPE_CHECKING:
     from PIL.Image import Image as PILImageType
 
-# Pillow 라이브러리 임포트 시도
-try:
-    from PIL import Image
-    from PIL.Image import Image as PILImage
-except ImportError:
-    Image = None
-    PILImage = Any  # type: ignore
+# Pillow / google-generativeai는 첫 사용 시점에 지연 임포트 (콜드 스타트 단축)
 
-# google-generativeai 라이브러리 임포트 시도
+# orjson 라이브러리 임포트 시도 (없으면 표준 json 사용)
 try:
-    import google.generativeai as genai
+    import orjson
 except ImportError:
-    genai = None  # type: ignore
+    orjson = None  # type: ignore
 
 # 페이지 설정
 st.set_page_config(
@@ -41,69 +45,18 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# 커스텀 CSS - 건강 상태별 색상 및 모던 UI
-st.markdown("""
-    <style>
-    .main {
-        background-color: #ffffff;
-    }
-    .stButton>button {
-        background-color: #4CAF50;
-        color: white;
-        border-radius: 8px;
-        border: none;
-        padding: 0.5rem 1rem;
-        font-weight: 600;
-        transition: all 0.3s;
-    }
-    .stButton>button:hover {
-        background-color: #45a049;
-        transform: translateY(-2px);
-        box-shadow: 0 4px 8px rgba(0,0,0,0.1);
-    }
-    .health-healthy {
-        background: linear-gradient(135deg, #4CAF50 0%, #81C784 100%);
-        color: white;
-        padding: 1rem;
-        border-radius: 12px;
-        text-align: center;
-        font-weight: bold;
-    }
-    .health-moderate {
-        background: linear-gradient(135deg, #FF9800 0%, #FFB74D 100%);
-        color: white;
-        padding: 1rem;
-        border-radius: 12px;
-        text-align: center;
-        font-weight: bold;
-    }
-    .health-high-risk {
-        background: linear-gradient(135deg, #f44336 0%, #e57373 100%);
-        color: white;
-        padding: 1rem;
-        border-radius: 12px;
-        text-align: center;
-        font-weight: bold;
-    }
-    .metric-card {
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-        color: white;
-        padding: 1.5rem;
-        border-radius: 12px;
-        box-shadow: 0 4px 15px rgba(0,0,0,0.1);
-    }
-    h1 { color: #2c3e50; font-weight: 700; }
-    h2 { color: #34495e; font-weight: 600; border-bottom: 2px solid #e0e0e0; padding-bottom: 0.5rem; }
-    h3 { color: #7f8c8d; font-weight: 500; }
-    .report-section {
-        background-color: #f8f9fa;
-        border-left: 4px solid #4CAF50;
-        padding: 1rem;
-        margin: 1rem 0;
-        border-radius: 0 8px 8px 0;
-    }
-    </style>
-    """, unsafe_allow_html=True)
+# 커스텀 CSS 파일 - 건강 상태별 색상 및 모던 UI
+STYLE_PATH = Path(__file__).parent / "style.css"
+
+# 페이지 헤더
+HEADER_HTML = """
+    <div style='text-align: center'>
+        <h1>🏭 AM 공정 분석 도구</h1>
+        <p style='color: #7f8c8d; font-size: 1.1em'>
+            통계 데이터 → 장인의 암묵지 v3.0
+        </p>
+    </div>
+"""
 
 # 모델 매핑 딕셔너리
 MODEL_MAPPING = {
@@ -112,350 +65,524 @@ MODEL_MAPPING = {
     "고급 (Pro)": "gemini-2.5-pro"
 }
 
+# 공통 생성 설정 (최대 출력 토큰은 분석 유형별로 호출 시 지정, 읽기 전용)
+GENERATION_CONFIG = MappingProxyType({
+    "temperature": 0.7,
+    "top_p": 0.95,
+    "top_k": 20
+})
+
+# 안전 필터 설정 - 기술 보고서 특성상 차단 비활성화
+SAFETY_SETTINGS = MappingProxyType({
+    'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE',
+    'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_NONE',
+    'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_NONE',
+    'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_NONE'
+})
+
+# 분석 유형별 기본 최대 출력 토큰 (보고서 템플릿 분량 기준)
+MAX_OUTPUT_TOKENS = {
+    "full": 16384,
+    "brief": 6144
+}
+
+# 모델별 사고(thinking) 토큰 여유분 - Gemini 2.5는 사고 토큰도 max_output_tokens에서 차감
+# (SDK가 thinking_budget 미지원 → 보고서 분량에 여유분을 더해 요청, Flash-Lite는 기본 사고 없음)
+THINKING_TOKEN_RESERVE = {
+    "gemini-2.5-flash-lite": 0,
+    "gemini-2.5-flash": 8192,
+    "gemini-2.5-pro": 16384
+}
+
+# 모델 출력 토큰 한도 (Gemini 2.5 공통)
+MODEL_OUTPUT_TOKEN_LIMIT = 65536
+
+# 세션 상태 기본값
+SESSION_DEFAULTS = {
+    'api_key': os.environ.get("API_KEY", ""),
+    'model_name': "보통 (Flash)",
+    'report_generated': False,
+    'report_content': "",
+    'report_model': "",
+    'report_sections': [],
+    'report_timestamp': None,
+    'analysis_type': "full",
+    'parsed_health': None,
+    'parsed_health_dict': None,
+    'parsed_ica': None,
+    'report_digest': None,
+    'stats_content': "",
+    'comparison_reports': {}
+}
+
+# 모델 입력 토큰 한도 (Gemini 2.5 공통)
+MODEL_INPUT_TOKEN_LIMIT = 1048576
+
+# 로컬 입력 토큰 상한 추정 - 텍스트는 문자당 최대 1토큰,
+# 이미지는 1024px 이하 기준 최대 4타일 × 258토큰
+IMAGE_TOKEN_ESTIMATE = 4 * 258
+
+# 간략 분석 입력이 이 토큰 수 미만이면 Flash-Lite로 자동 전환
+LITE_ROUTING_MAX_TOKENS = 4096
+LITE_MODEL_NAME = "간단 (Flash-Lite)"
+
+# 정형 보고서 대체 기준 - HEALTHY + critical_issues 없음 + 점수 이상이면 모델 호출 생략
+HEALTHY_TEMPLATE_MIN_SCORE = 0.90
+
+# 컨텍스트 캐시 설정 - 정적 프롬프트를 1회만 업로드하고 이후 호출은 캐시 참조
+CONTEXT_CACHE_TTL = timedelta(hours=1)
+
+# 캐시 생성 실패(일시적 API 오류/할당량 초과) 시 재시도까지 대기 시간
+CONTEXT_CACHE_RETRY_AFTER = timedelta(minutes=5)
+
+# 모델별 컨텍스트 캐시 최소 토큰 수 (미달 시 인라인 프롬프트로 전송)
+CONTEXT_CACHE_MIN_TOKENS = {
+    "gemini-2.5-flash-lite": 1024,
+    "gemini-2.5-flash": 1024,
+    "gemini-2.5-pro": 4096
+}
+
+# 그래프 미리보기 썸네일 최대 크기 (px)
+PREVIEW_THUMBNAIL_SIZE = (300, 300)
+
+# PNG로 그대로 저장 가능한 이미지 모드 (그 외 CMYK 등은 RGB 변환)
+PNG_SAFE_MODES = ("RGB", "RGBA", "L", "LA", "P")
+
+# Gemini 전송용 그래프 최대 크기 (px, 긴 변 기준)
+UPLOAD_IMAGE_MAX_SIZE = (1024, 1024)
+
+# 전송용 인코딩 설정 - 평탄한 배경의 그래프는 WEBP가 JPEG보다 작음
+UPLOAD_WEBP_QUALITY = 80
+UPLOAD_WEBP_METHOD = 4
+UPLOAD_JPEG_QUALITY = 85  # WEBP 미지원 Pillow 빌드용
+
+# 응답 캐시 설정 - 동일 입력 재분석 시 API 호출 생략
+RESPONSE_CACHE_DIR = Path.home() / ".am_cache"
+RESPONSE_CACHE_TTL = 86400  # 초 (24시간)
+
+# LLM_Ready_Report.txt 필드 값 패턴 (모듈 로드 시 1회 컴파일)
+_WORD_RE = re.compile(r'\w+')
+_NUMBER_RE = re.compile(r'[\d.]+')
+_INT_RE = re.compile(r'\d+')
+_TEXT_RE = re.compile(r'.+')
+
+# PROCESS_HEALTH 섹션 필드: key → (값 패턴, 변환 함수)
+_HEALTH_FIELDS = {
+    'overall_status': (_WORD_RE, str),
+    'health_score': (_NUMBER_RE, float),
+    'energy_concentration_status': (_WORD_RE, str),
+    'mode1_energy_pct': (_NUMBER_RE, float),
+    'category_balance_status': (_WORD_RE, str),
+    'recommendation': (_TEXT_RE, str)
+}
+
+# ICA 필드 (파일 전체에서 최초 값 사용)
+_ICA_FIELDS = {
+    'total_components': (_INT_RE, int),
+    'problematic_count': (_INT_RE, int)
+}
+
+_HEALTH_HEADER = '=== PROCESS_HEALTH ===\n'
+
+# 보고서 섹션 경계 ('## ' 제목 줄 앞에서 분할, '###' 하위 제목은 제외)
+_SECTION_RE = re.compile(r'^(?=## )', re.MULTILINE)
+
 # ============================================================
 # PROCESS_HEALTH 연동 프롬프트 (새 포맷)
 # ============================================================
 
-AM_EXPERT_PROMPT = """<ROLE>
-역할: L-PBF/EBM/DED 등 적층제조(AM) 공정 품질진단 전문가
-대상: 통계 비전문가인 현장 엔지니어 및 공정 관리자
-핵심 원칙: **통계 데이터를 장인의 암묵지처럼 해석**하여 AM 전문가가 직관적으로 판단할 수 있게 변환
-
-문체 규칙:
-- 개조식 단문, 명사형 종결
-- 통계 용어 최소화, AM 터미놀러지 우선 사용
-- 수치: 소수점 1~2자리, 단위 필수 (분, %, 1/s, Hz, ppm)
-</ROLE>
-
-<AM_TERMINOLOGY>
-필수 사용 용어 (통계 → AM 변환):
-- SVD Mode → 공정 지배 패턴 (예: "Mode1이 98% = 단일 패턴이 공정 지배")
-- ICA Component → 독립 신호 분리 결과 (예: "IC 8개 모두 impulsive = 불안정 신호 다수")
-- DMD Growth Rate → 시간 성장률 (예: "양의 성장률 = 점진적 악화 징후")
-- Energy Concentration → 에너지 집중도 (예: "Mode1 >80% = 안정적 단일 모드 지배")
-- CV (Coefficient of Variation) → 변동계수 (예: "CV >10% = 센서 출렁임 주의")
-- Anomaly Cluster → 이상 구간 (연속적 이상 발생 지점)
-
-AM 현장 용어:
-- 리코터(Recoater): 분말 도포 장치
-- 해치(Hatch): 내부 스캔 패턴
-- 콘투어(Contour): 외곽 스캔 패턴
-- 가스 퍼지(Gas Purge): 챔버 가스 순환
-- O₂ ppm: 산소 농도 (낮을수록 양호, 보통 <500ppm 목표)
-- 스패터(Spatter): 용융풀에서 튀는 분말/금속
-- 키홀(Keyhole): 과도 에너지로 인한 깊은 용융풀
-- LOF (Lack of Fusion): 불완전 용융 결함
-- 에너지 밀도: 레이저 출력/스캔속도/해치간격의 함수
-- 열 누적: 빌드 진행 중 열 축적 현상
-</AM_TERMINOLOGY>
-
-<PROCESS_HEALTH_INTERPRETATION>
-**PROCESS_HEALTH 섹션 해석 가이드:**
-
-1. overall_status 해석:
-   - HEALTHY (health_score ≥0.85): 공정 정상. 모니터링 유지.
-   - MODERATE_RISK (0.60~0.85): 주의 필요. 예방적 점검 권장.
-   - HIGH_RISK (<0.60): 즉시 조치 필요. 심각한 이상 징후.
-
-2. energy_concentration_status 해석:
-   - STABLE: Mode1 에너지 >80%. 단일 패턴 지배. 예측 가능한 공정.
-   - WARNING: Mode1 에너지 50~80%. 복합 패턴. 모니터링 강화.
-   - UNSTABLE: Mode1 에너지 <50%. 다중 패턴 혼재. 공정 불안정.
-
-3. category_balance_status 해석:
-   - BALANCED: motion/gas 비율 0.5~2.0. 센서 카테고리 균형.
-   - MOTION_DOMINANT: 스캔 시스템(갈보/서보) 이상 징후.
-   - GAS_DOMINANT: 가스/분위기 시스템 이상 징후.
-
-4. critical_issues / warnings 해석:
-   - ICA problematic ratio >50%: 독립 신호 대부분이 비정상 → 심각
-   - Oxygen sensors dominating: 산소 센서가 공정 지배 → 분위기 문제
-   - High CV: 해당 센서 출렁임 심함 → 캘리브레이션/점검 필요
-</PROCESS_HEALTH_INTERPRETATION>
-
-<SAFETY_GUARDS>
-- 원인 단정 금지. "의심", "가능성", "징후" 표현 사용.
-- 대안 가설 1개 병기. Confidence(High/Med/Low) 표기.
-- 데이터 부족/불일치 시 '판단 보류' 또는 '추가 확인 필요' 명시.
-- 그래프는 번호(그래프 N)로만 인용. 본문 상세 묘사는 부록에서만.
-- 동일 수치 재인용 금지. 최초 표만 제시, 이후 'KPI 표 참조'.
-- 현장 안전 우선: 액션은 가역적·저비용·위험저감 순으로 제시.
-</SAFETY_GUARDS>
-
-<CONSISTENCY_RULES>
-Self-consistency(텍스트 vs 플롯) 필수:
-- 각 항목을 MATCH/MISMATCH로 표기
-- MISMATCH 발생 시: 결론 강도 1단계 하향, 원인 1문장 기재
-
-Confidence 산정:
-- High: 증거 ≥2종 일치 + Self-consistency 대부분 MATCH
-- Med: 증거 ≥1종 일치 또는 일부 불확실
-- Low: 증거 부족 또는 MISMATCH 존재
-</CONSISTENCY_RULES>
-
-<DECISION_RULES>
-위험 신호등 기준 (PROCESS_HEALTH 기반):
-- 🔴 HIGH_RISK: health_score <0.60 또는 critical_issues 존재 또는 다운타임 >30분
-- 🟡 MODERATE_RISK: health_score 0.60~0.85 또는 warnings 존재
-- 🟢 HEALTHY: health_score ≥0.85 AND warnings 최소
-
-결론 강도 억제:
-- 단일 지표로 중대한 결론 금지
-- 서로 다른 출처 2개 이상 합의 필요 (SVD/ICA/DMD/IForest)
-</DECISION_RULES>
-
-<REPORT_STRUCTURE>
-## 1. 서론
-- 공정: {process_type}. 장비/소재: {machine}/{material}.
-- 목적: 빌드 안정성 점검 및 이상 원인 가설 도출.
-- 데이터: 원본 {shape_original}, 처리 {shape_processed}, 해상도 {dt_sec}s.
-- **공정 건강 상태: {overall_status} (점수: {health_score}/1.00)**
-- 범위: 통계 신호 기반. 장비 이벤트 로그/현장 점검 미포함.
-
-## 2. 핵심 지표(KPI) 요약 ※표 형식 고정
-| 항목 | 값 | 단위 | AM 해석 |
-|---|---:|:---:|---|
-| 공정 건강 점수 | {health_score} | /1.00 | 신호등 {risk_emoji} |
-| 에너지 집중도 | {mode1_energy_pct} | % | {energy_status} |
-| SVD 유효 모드 | {significant_modes} | 개 | 공정 복잡도 |
-| 90% 에너지 컴포넌트 | {energy_90_components} | 개 | 지배 패턴 수 |
-| ICA 문제 비율 | {ica_problematic_ratio} | % | 독립신호 이상률 |
-| DMD 불안정 모드 | {total_unstable_modes} | 개 | 성장 신호 존재 |
-| DMD 최대 성장률 | {max_growth_rate} | 1/s | 열 누적/진동 추정 |
-| 이상률(SVD) | {svd_anomaly_rate} | % | 선형 이상 비율 |
-| 이상치(IForest) | {anomaly_count} | 개 | 비선형 이상 지점 |
-- 요약 판단: {summary_judgment}
-- 주요 원인 가설 + 대안 가설. Confidence={conf}.
-- 즉시 조치 방향 1문장.
-
-## 3. 공정 상태 해석 (AM 관점) ※그래프는 번호만 인용
-### 3.1 가스·분위기 (O₂ ppm, 가스 퍼지, 필터 ΔP)
-- 증거: {gas_evidence}. (그래프 {gas_graphs} 참조)
-- 해석: 보호가스 유지/스패터 제거 적정성.
-- 영향: 산화/LOF·기공 위험도. Confidence={gas_conf}.
-
-### 3.2 레이저·스캔 (파워, 해치, 콘투어)
-- 증거: {laser_evidence}. (그래프 {laser_graphs} 참조)
-- 해석: 에너지 밀도/키홀·스패터 위험도.
-- 영향: 용융풀 안정/표면 조도. Confidence={laser_conf}.
-
-### 3.3 열·스테이지 (열 누적, 플랫폼, 리코터)
-- 증거: {thermal_evidence}. (그래프 {thermal_graphs} 참조)
-- 해석: 저주파 성장→열 누적 또는 리코터 간섭.
-- 영향: 변형/워핑/리코터 충돌 리스크. Confidence={thermal_conf}.
-
-## 4. 위험도 평가 (신호등) ※표 형식 고정
-| 순위 | 위험 요인(가설) | 영향도 | 근거 | 조치 우선 | Confidence |
-|---:|---|:---:|---|---|---|
-| 1 | {risk1} | {emoji1} | {evidence1} | 즉시 | {conf1} |
-| 2 | {risk2} | {emoji2} | {evidence2} | 1~2주 | {conf2} |
-| 3 | {risk3} | {emoji3} | {evidence3} | 정기 | {conf3} |
-
-### 4.1 문제 센서 (상위)
-| 센서 | 이상 유형 | 정량 근거 | 권장 조치 |
-|---|---|---|---|
-| {sensor1} | {type1} | {stats1} | {action1} |
-| {sensor2} | {type2} | {stats2} | {action2} |
-
-## 5. 실행 조치 (액션 플랜) ※체크리스트, 각 3항목 이내
-### 5.1 즉시 (24시간)
-- [ ] {immediate_1}. 근거: {imm_evidence1}. 기대효과: {imm_effect1}.
-- [ ] {immediate_2}. 필요 자원: {imm_resource}.
-- [ ] 가스·레이저·리코터 현장 점검. 로그 대조 필수.
+# 분석 유형별 프롬프트 파일 (prompts/*.md)
+PROMPT_DIR = Path(__file__).parent / "prompts"
+PROMPT_FILES = {
+    "full": "am_analysis",    # 전체 분석 (그래프 포함)
+    "brief": "am_brief"       # 간결형 보고서 (그래프 없음)
+}
+
 
-### 5.2 단기 (1~2주)
-- [ ] {short_1}. 검증: 시험 쿠폰/NDE.
-- [ ] {short_2}. 지표: 불량률/다운타임 감소.
+@st.cache_data(show_spinner=False)
+def load_prompt(name: str) -> str:
+    """프롬프트 파일 로드 (재실행 간 캐시, 프로세스당 1회 디스크 읽기)"""
+    return (PROMPT_DIR / f"{name}.md").read_text(encoding='utf-8')
 
-### 5.3 중장기 (1~3개월)
-- [ ] {long_1}. ROI: {roi_note}.
-- [ ] {long_2}. 단계별 적용 및 리스크 관리.
 
-## 6. 결론
-- 핵심 발견 1문장. (KPI 표 참조)
-- 예상 영향 1문장. 생산/품질 관점.
-- 우선 조치 1문장. 일정·책임 명시.
-- 모니터링 계획 1문장. 핵심 지표·주기.
+@st.cache_data(show_spinner=False)
+def load_css() -> str:
+    """style.css를 <style> 블록으로 로드 (재실행 간 캐시, 프로세스당 1회 디스크 읽기)"""
+    return f"<style>\n{STYLE_PATH.read_text(encoding='utf-8')}</style>"
 
----
-## 부록 A. 그래프 요약 (각 2문장)
-### 그래프 1~10
-각 그래프별: 목적/유형 + 핵심 증거 + 본문 연계
-
-</REPORT_STRUCTURE>
-
-<OUTPUT_FORMAT>
-- 마크다운 형식 사용
-- 표는 반드시 파이프(|) 형식으로 정렬
-- 체크리스트는 - [ ] 형식
-- 신호등 이모지: 🔴 (HIGH_RISK), 🟡 (MODERATE_RISK), 🟢 (HEALTHY)
-- 섹션 구분 명확히 (##, ###)
-- 그래프 인용 시 "(그래프 N 참조)" 형식만 사용
-</OUTPUT_FORMAT>
-
-<QUALITY_GUARDS>
-- 원인 진단은 가설. 대안 가설 1개 병기.
-- Self-consistency 불일치 시 MISMATCH 표기.
-- 그래프 상세 묘사 금지(부록 외).
-- 과도한 통계 설명 금지. AM 현상으로 번역.
-- 수치 반올림. 단위 표기 필수. 재인용 금지.
-</QUALITY_GUARDS>"""
-
-# 간결형 보고서 프롬프트 (그래프 없음)
-AM_BRIEF_EXPERT_PROMPT = """<ROLE>
-역할: L-PBF/EBM/DED 등 적층제조(AM) 공정 품질진단 전문가
-대상: 통계 비전문가인 현장 엔지니어
-핵심 원칙: **통계 데이터를 장인의 암묵지처럼 해석**
-
-문체: 개조식 단문, 명사형 종결, AM 용어 우선
-</ROLE>
-
-<AM_TERMINOLOGY>
-- 리코터, 해치, 콘투어, 가스 퍼지, O₂ ppm, 스패터, 키홀, LOF
-- SVD Mode → 공정 지배 패턴
-- ICA Component → 독립 신호 분리 결과
-- Energy Concentration → 에너지 집중도
-- CV → 변동계수 (센서 출렁임 지표)
-</AM_TERMINOLOGY>
-
-<PROCESS_HEALTH_INTERPRETATION>
-PROCESS_HEALTH 섹션 기반 판단:
-- overall_status: HEALTHY/MODERATE_RISK/HIGH_RISK
-- health_score: 0~1 범위 (≥0.85 양호, 0.60~0.85 주의, <0.60 위험)
-- critical_issues: 즉시 조치 필요 항목
-- warnings: 모니터링 필요 항목
-- recommendation: 시스템 권장 조치
-</PROCESS_HEALTH_INTERPRETATION>
-
-<BRIEF_REPORT_STRUCTURE>
-## 1. 개요
-- 공정/데이터 요약
-- **공정 건강: {overall_status} ({health_score}/1.00)**
-
-## 2. 핵심 KPI 요약 (표)
+
+def inject_css() -> None:
+    """커스텀 CSS 적용 (재실행마다 다시 그려야 스타일 유지)"""
+    st.markdown(load_css(), unsafe_allow_html=True)
+
+
+def render_header() -> None:
+    """페이지 헤더 표시"""
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col2:
+        st.markdown(HEADER_HTML, unsafe_allow_html=True)
+
+
+# 정상 공정용 정형 보고서 (간결형 보고서 구조 준수)
+HEALTHY_REPORT_TEMPLATE = """## 1. 개요
+- 공정 데이터: LLM_Ready_Report.txt PROCESS_HEALTH 섹션 기반 자동 판정
+- **공정 건강: {overall_status} ({health_score:.2f}/1.00)**
+- critical_issues 없음, 건강 점수 ≥{min_score:.2f} → 정형 보고서로 대체 (AI 모델 미호출)
+
+## 2. 핵심 KPI 요약
 | 항목 | 값 | AM 해석 |
 |---|---:|---|
+| 공정 건강 점수 | {health_score:.2f} /1.00 | 신호등 🟢 |
+| 에너지 집중도 (Mode1) | {mode1_energy_pct:.1f}% | {energy_concentration_status} |
+| 센서 카테고리 균형 | {category_balance_status} | motion/gas 비율 상태 |
+| ICA 문제 비율 | {problematic_ratio:.0f}% ({problematic_count}/{total_components}개) | 독립신호 이상률 |
 
 ## 3. 공정 해석 (AM 관점)
 ### 3.1 가스·분위기
+- 분위기 이상 징후 미검출. O₂ ppm 정기 확인 유지.
 ### 3.2 레이저·스캔
+- 에너지 집중도 {energy_concentration_status}. 용융풀 안정 구간 추정.
 ### 3.3 열·스테이지
+- 열 누적/리코터 간섭 징후 미검출. 추가 확인 필요 시 상세 분석 실행.
 
-## 4. 위험도 및 문제 센서 (표 2개)
+## 4. 위험도 및 모니터링 항목
+| 구분 | 내용 |
+|---|---|
+| 위험도 | 🟢 HEALTHY |
+| 모니터링 항목 | {warnings} |
 
-## 5. 실행 조치 (체크리스트)
+## 5. 실행 조치
 ### 5.1 즉시 (24h)
+- [ ] 긴급 조치 불필요. {recommendation}
 ### 5.2 단기 (1~2주)
+- [ ] 경고 항목 추이 확인. 건강 점수 하락 시 상세 분석 실행.
 ### 5.3 중장기 (1~3개월)
-</BRIEF_REPORT_STRUCTURE>
+- [ ] 정상 빌드 데이터 축적. 기준선(baseline) 갱신.
+"""
+
+
+class IncompleteResponseError(ValueError):
+    """모델 응답이 비었거나 중단됨 (캐시 저장/보고서 완료 처리 생략)"""
+
+
+@dataclass(slots=True, frozen=True)
+class HealthReport:
+    """PROCESS_HEALTH 섹션 파싱 결과"""
+    overall_status: str = 'UNKNOWN'
+    health_score: float = 0.0
+    energy_concentration_status: str = 'UNKNOWN'
+    mode1_energy_pct: float = 0.0
+    category_balance_status: str = 'UNKNOWN'
+    critical_issues: Tuple[str, ...] = ()
+    warnings: Tuple[str, ...] = ()
+    recommendation: str = ''
+
+    def as_dict(self) -> Dict[str, Any]:
+        """JSON 직렬화용 dict 변환"""
+        return asdict(self)
+
 
-<SAFETY_GUARDS>
-- 그래프 언급 금지 (간결형)
-- 원인 단정 금지, 대안 가설 병기
-- 데이터 부족 시 '판단 보류'
-</SAFETY_GUARDS>"""
+def is_installed(module: str) -> bool:
+    """모듈 설치 여부 확인 (임포트 없이 모듈 스펙만 조회)"""
+    try:
+        return importlib.util.find_spec(module) is not None
+    except ModuleNotFoundError:
+        # 상위 패키지(google 등)가 없는 경우
+        return False
 
 
 def check_requirements():
     """필수 패키지 확인"""
     missing_packages = []
-    if genai is None:
+    if not is_installed("google.generativeai"):
         missing_packages.append("google-generativeai")
-    if Image is None:
+    if not is_installed("PIL"):
         missing_packages.append("Pillow")
     return missing_packages
 
 
-def initialize_session_state() -> None:
-    """세션 상태 초기화"""
-    defaults = {
-        'api_key': os.environ.get("API_KEY", ""),
-        'model_name': "보통 (Flash)",
-        'report_generated': False,
-        'report_content': "",
-        'analysis_type': "full",
-        'parsed_health': None
-    }
-    for key, value in defaults.items():
-        if key not in st.session_state:
-            st.session_state[key] = value
-
-
-def parse_process_health(content: str) -> Dict[str, Any]:
-    """LLM_Ready_Report.txt에서 PROCESS_HEALTH 섹션 파싱"""
-    health_data = {
-        'overall_status': 'UNKNOWN',
-        'health_score': 0.0,
-        'energy_concentration_status': 'UNKNOWN',
-        'mode1_energy_pct': 0.0,
-        'category_balance_status': 'UNKNOWN',
-        'critical_issues': [],
-        'warnings': [],
-        'recommendation': ''
-    }
+def suggest_pillow_simd() -> Optional[str]:
+    """x86_64에서 Pillow-SIMD 미사용 시 설치 명령 반환 (해당 없으면 None)"""
+    # ARM(라즈베리 파이 등)은 SSE4/AVX2 미지원 - 일반 Pillow 유지
+    if platform.machine().lower() not in ("x86_64", "amd64"):
+        return None
+    try:
+        importlib.metadata.version("Pillow-SIMD")
+        return None
+    except importlib.metadata.PackageNotFoundError:
+        pass
+    if is_installed("PIL"):
+        return "pip uninstall -y pillow && pip install pillow-simd"
+    return "pip install pillow-simd"
 
-    # PROCESS_HEALTH 섹션 찾기
-    health_match = re.search(r'=== PROCESS_HEALTH ===\n(.*?)(?:\n===|$)', content, re.DOTALL)
-    if not health_match:
-        return health_data
-
-    health_section = health_match.group(1)
-
-    # 각 필드 파싱
-    patterns = {
-        'overall_status': r'overall_status=(\w+)',
-        'health_score': r'health_score=([\d.]+)',
-        'energy_concentration_status': r'energy_concentration_status=(\w+)',
-        'mode1_energy_pct': r'mode1_energy_pct=([\d.]+)',
-        'category_balance_status': r'category_balance_status=(\w+)',
-        'recommendation': r'recommendation=(.+?)(?:\n|$)'
-    }
 
-    for key, pattern in patterns.items():
-        match = re.search(pattern, health_section)
-        if match:
-            value = match.group(1)
-            if key in ['health_score', 'mode1_energy_pct']:
-                health_data[key] = float(value)
-            else:
-                health_data[key] = value
+def configure_genai(api_key: str) -> None:
+    """google-generativeai 임포트 + API 키 설정"""
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+
+
+def initialize_session_state() -> None:
+    """세션 상태 초기화 (없는 키만 기본값으로 채움)"""
+    for key, value in SESSION_DEFAULTS.items():
+        # 가변 기본값은 세션 간 공유되지 않도록 복사
+        st.session_state.setdefault(
+            key, value.copy() if isinstance(value, (dict, list)) else value
+        )
 
-    # critical_issues 파싱
-    critical_match = re.search(r'critical_issues:\n((?:  - .+\n)*)', health_section)
-    if critical_match:
-        issues = re.findall(r'  - (.+)', critical_match.group(1))
-        health_data['critical_issues'] = issues
 
-    # warnings 파싱
-    warnings_match = re.search(r'warnings:\n((?:  - .+\n)*)', health_section)
-    if warnings_match:
-        warnings = re.findall(r'  - (.+)', warnings_match.group(1))
-        health_data['warnings'] = warnings
+def parse_list_block(section: str, label: str) -> List[str]:
+    """label 바로 다음 줄부터 이어지는 '  - ' 항목 수집"""
+    start = section.find(label)
+    if start < 0:
+        return []
 
-    return health_data
+    items = []
+    for line in section[start + len(label):].splitlines():
+        if not line.startswith('  - ') or len(line) <= 4:
+            break
+        items.append(line[4:])
+    return items
 
 
-def parse_ica_info(content: str) -> Dict[str, Any]:
-    """ICA 분석 정보 파싱"""
+def parse_report(content: str) -> Dict[str, Any]:
+    """LLM_Ready_Report.txt 파싱 (PROCESS_HEALTH + ICA)"""
     ica_data = {
         'total_components': 0,
         'problematic_count': 0,
         'problematic_ratio': 0.0
     }
 
-    total_match = re.search(r'total_components=(\d+)', content)
-    prob_match = re.search(r'problematic_count=(\d+)', content)
-
-    if total_match:
-        ica_data['total_components'] = int(total_match.group(1))
-    if prob_match:
-        ica_data['problematic_count'] = int(prob_match.group(1))
+    # ICA 필드: str.find로 위치만 찾고 값 패턴은 해당 위치에서만 매칭
+    for key, (pattern, convert) in _ICA_FIELDS.items():
+        marker = f'{key}='
+        pos = content.find(marker)
+        while pos >= 0:
+            match = pattern.match(content, pos + len(marker))
+            if match:
+                ica_data[key] = convert(match.group())
+                break
+            pos = content.find(marker, pos + 1)
 
     if ica_data['total_components'] > 0:
         ica_data['problematic_ratio'] = (ica_data['problematic_count'] /
                                           ica_data['total_components']) * 100
 
-    return ica_data
+    # PROCESS_HEALTH 섹션만 잘라서 스캔 (다음 === 헤더 이후는 읽지 않음)
+    start = content.find(_HEALTH_HEADER)
+    if start < 0:
+        return {'health': HealthReport(), 'ica': ica_data}
+    start += len(_HEALTH_HEADER)
+    end = content.find('\n===', start)
+    health_section = content[start:end if end >= 0 else len(content)]
+
+    # 찾은 필드만 채우고 나머지는 HealthReport 기본값 사용
+    health_data = {}
+
+    # critical_issues / warnings 목록
+    health_data['critical_issues'] = tuple(parse_list_block(health_section, 'critical_issues:\n'))
+    health_data['warnings'] = tuple(parse_list_block(health_section, 'warnings:\n'))
+
+    found = set()
+    for line in health_section.split('\n'):
+        key, sep, value = line.partition('=')
+        key = key.strip()
+        field = _HEALTH_FIELDS.get(key)
+        if not sep or field is None or key in found:
+            continue
+
+        pattern, convert = field
+        match = pattern.match(value)
+        if match:
+            health_data[key] = convert(match.group())
+            found.add(key)
+
+    return {'health': HealthReport(**health_data), 'ica': ica_data}
+
+
+# 업로드 파일/보고서 단위 캐시 - 세션 간 공유되므로 개수와 보관 시간(1시간) 제한
+@st.cache_data(show_spinner=False, max_entries=20, ttl=3600)
+def load_report(raw_bytes: bytes) -> tuple:
+    """업로드 파일 디코딩 + 파싱 (파일 내용 기준 캐시, 재실행 시 재사용)"""
+    content = raw_bytes.decode('utf-8')
+    parsed = parse_report(content)
+    return content, parsed['health'], parsed['ica']
+
+
+@st.cache_resource(show_spinner=False, max_entries=30)
+def open_image(digest: str, _data: bytes) -> "PILImageType":
+    """업로드 이미지 디코딩 (파일 SHA-1 기준 캐시, 미리보기/추론 공용)"""
+    from PIL import Image
+
+    # 세션 간 공유 객체 - 호출 측에서 thumbnail() 등 제자리 변경 금지
+    img = Image.open(io.BytesIO(_data))
+    img.load()
+    return img
+
+
+def open_uploaded_image(data: bytes) -> "PILImageType":
+    """업로드 바이트의 디코딩 이미지 조회 (캐시 재사용)"""
+    return open_image(hashlib.sha1(data).hexdigest(), data)
+
+
+@st.cache_data(show_spinner=False, max_entries=100)
+def build_thumbnail(digest: str, _data: bytes) -> bytes:
+    """미리보기 썸네일 PNG 생성 (파일 SHA-1 기준 캐시)"""
+    from PIL import Image, ImageOps
+
+    img = Image.open(io.BytesIO(_data))
+    if img.format == "JPEG":
+        # JPEG는 축소 디코딩(shrink-on-load)으로 전체 해상도 로드 생략
+        img.draft("RGB", (PREVIEW_THUMBNAIL_SIZE[0] * 2, PREVIEW_THUMBNAIL_SIZE[1] * 2))
+    else:
+        img = open_image(digest, _data)
+
+    if img.mode not in PNG_SAFE_MODES:
+        img = img.convert("RGB")
+    if max(img.size) > max(PREVIEW_THUMBNAIL_SIZE):
+        img = ImageOps.contain(img, PREVIEW_THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def make_thumbnail(file: Any) -> bytes:
+    """업로드 파일의 미리보기 썸네일 조회"""
+    data = file.getvalue()
+    return build_thumbnail(hashlib.sha1(data).hexdigest(), data)
+
+
+@st.cache_data(show_spinner=False, max_entries=20, ttl=3600)
+def build_report_md(
+    report_content: str,
+    timestamp: str,
+    model_name: str,
+    analysis_type: str,
+    process_health: Optional[Dict[str, Any]]
+) -> bytes:
+    """Markdown 다운로드 데이터 생성 (보고서당 1회 직렬화)"""
+    health_info = ""
+    if process_health:
+        health_info = (
+            f"\n**공정 상태:** {process_health['overall_status']} "
+            f"(점수: {process_health['health_score']:.2f})"
+        )
+
+    report_md = f"""# AM 공정 분석 보고서
+
+**생성 시간:** {timestamp}
+**사용 모델:** {model_name}
+**분석 유형:** {'전체 분석' if analysis_type == 'full' else '간략 분석'}{health_info}
+
+---
+
+{report_content}"""
+    return report_md.encode('utf-8')
+
+
+@st.cache_data(show_spinner=False, max_entries=20, ttl=3600)
+def build_report_json(
+    report_content: str,
+    timestamp: str,
+    model_name: str,
+    analysis_type: str,
+    process_health: Optional[Dict[str, Any]]
+) -> bytes:
+    """JSON 다운로드 데이터 생성 (보고서당 1회 직렬화)"""
+    json_data = {
+        "timestamp": timestamp,
+        "model": model_name,
+        "analysis_type": analysis_type,
+        "process_health": process_health,
+        "report": report_content
+    }
+    if orjson is not None:
+        return orjson.dumps(json_data, option=orjson.OPT_INDENT_2)
+    return json.dumps(json_data, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+def is_healthy_shortcut(health: Optional[HealthReport]) -> bool:
+    """정형 보고서로 대체 가능한 정상 공정인지 판정"""
+    return bool(
+        health
+        and health.overall_status == 'HEALTHY'
+        and not health.critical_issues
+        and health.health_score >= HEALTHY_TEMPLATE_MIN_SCORE
+    )
+
+
+def split_report_sections(content: str) -> List[str]:
+    """보고서를 '## ' 제목 단위로 분할 (빈 조각 제외)"""
+    return [section for section in _SECTION_RE.split(content) if section.strip()]
+
+
+def render_healthy_template(health: HealthReport, ica: Dict[str, Any]) -> str:
+    """정상 공정 정형 보고서 생성 (모델 호출 없음)"""
+    return HEALTHY_REPORT_TEMPLATE.format(
+        overall_status=health.overall_status,
+        health_score=health.health_score,
+        min_score=HEALTHY_TEMPLATE_MIN_SCORE,
+        mode1_energy_pct=health.mode1_energy_pct,
+        energy_concentration_status=health.energy_concentration_status,
+        category_balance_status=health.category_balance_status,
+        problematic_ratio=ica['problematic_ratio'],
+        problematic_count=ica['problematic_count'],
+        total_components=ica['total_components'],
+        warnings=", ".join(health.warnings) or "없음",
+        recommendation=health.recommendation or "정기 모니터링 유지."
+    )
+
+
+def flatten_to_rgb(img: "PILImageType") -> "PILImageType":
+    """손실 인코딩용 RGB 변환 (투명 영역은 흰 배경으로 합성)"""
+    from PIL import Image
+
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        rgba = img.convert("RGBA")
+        background = Image.new("RGB", rgba.size, "white")
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        return background
+    return img.convert("RGB")
+
+
+def prepare_graph_image(data: bytes) -> Dict[str, Any]:
+    """Gemini 전송용 그래프 디코딩 + 축소 + WEBP 인코딩 (워커 스레드에서 호출)"""
+    from PIL import Image, ImageOps, features
+
+    # 미리보기와 공유하는 디코딩 캐시 - cache_resource는 워커 스레드에서도 동작
+    img = open_uploaded_image(data)
+    small = max(img.size) <= max(UPLOAD_IMAGE_MAX_SIZE)
+    if small and img.format in ("JPEG", "WEBP"):
+        # 이미 작은 손실 압축 이미지는 원본 그대로 전송
+        return {"mime_type": Image.MIME[img.format], "data": data}
+
+    rgb = flatten_to_rgb(img)
+    if not small:
+        rgb = ImageOps.contain(rgb, UPLOAD_IMAGE_MAX_SIZE, Image.Resampling.LANCZOS)
+
+    buf = io.BytesIO()
+    if features.check("webp"):
+        rgb.save(buf, format="WEBP", quality=UPLOAD_WEBP_QUALITY, method=UPLOAD_WEBP_METHOD)
+        mime_type = "image/webp"
+    else:
+        # 소스 빌드(Pillow-SIMD 등)에서 libwebp가 없으면 JPEG로 대체
+        rgb.save(buf, format="JPEG", quality=UPLOAD_JPEG_QUALITY)
+        mime_type = "image/jpeg"
+
+    if small and buf.tell() >= len(data):
+        # 재인코딩해도 작아지지 않으면 원본 유지
+        return {"mime_type": Image.MIME.get(img.format, "image/png"), "data": data}
+    return {"mime_type": mime_type, "data": buf.getvalue()}
+
+
+@st.cache_data(show_spinner=False, max_entries=10, ttl=3600)
+def prepare_graph_images(datas: List[bytes]) -> List[Dict[str, Any]]:
+    """그래프 일괄 축소 (스레드 병렬 처리, 동일 업로드는 캐시 재사용)"""
+    if not datas:
+        return []
+    # 디코딩/리샘플링/인코딩은 C 확장에서 수행되므로 스레드로 병렬 처리
+    with ThreadPoolExecutor(max_workers=min(10, len(datas))) as executor:
+        return list(executor.map(prepare_graph_image, datas))
 
 
 def get_health_status_display(status: str, score: float) -> tuple:
@@ -468,39 +595,144 @@ def get_health_status_display(status: str, score: float) -> tuple:
         return ('🔴', 'health-high-risk', '위험', '#f44336')
 
 
-def run_inference(
+def create_prompt_cache(actual_model_name: str, prompt: str) -> Optional[Any]:
+    """정적 프롬프트의 컨텍스트 캐시 생성 (블로킹 API 호출, 스레드 안전, 최소 토큰 미달 시 None)"""
+    import google.generativeai as genai
+
+    # 최소 토큰 수 미달이면 캐시 생성 불가 → 인라인 경로 사용
+    min_tokens = CONTEXT_CACHE_MIN_TOKENS.get(actual_model_name, 4096)
+    prompt_tokens = genai.GenerativeModel(actual_model_name).count_tokens(prompt).total_tokens
+    if prompt_tokens < min_tokens:
+        return None
+    return genai.caching.CachedContent.create(
+        model=actual_model_name,
+        system_instruction=prompt,
+        ttl=CONTEXT_CACHE_TTL
+    )
+
+
+def get_prompt_caches(
     api_key: str,
+    actual_model_names: List[str],
+    prompt: str
+) -> Dict[str, Optional[Any]]:
+    """모델별 프롬프트 컨텍스트 캐시 조회/생성 (미보유 모델은 스레드로 동시 생성)"""
+    cache_store = st.session_state.setdefault('gemini_cache', {})
+    caches = {}
+    missing = []
+    for actual_model_name in actual_model_names:
+        key = hashlib.sha256(
+            f"{api_key}\n{actual_model_name}\n{prompt}".encode('utf-8')
+        ).hexdigest()
+        entry = cache_store.get(key)
+        if entry and entry['expires_at'] > time.time():
+            caches[actual_model_name] = entry['cache']
+        else:
+            missing.append((actual_model_name, key))
+
+    if missing:
+        # 세션 상태는 스크립트 스레드에서만 갱신 - 워커는 API 호출만 수행
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            futures = [executor.submit(create_prompt_cache, actual_model_name, prompt)
+                       for actual_model_name, _ in missing]
+        for (actual_model_name, key), future in zip(missing, futures):
+            try:
+                cache = future.result()
+                # 서버 측 만료 직전에 재생성되도록 1분 여유
+                ttl_seconds = CONTEXT_CACHE_TTL.total_seconds() - 60
+            except Exception:
+                # 생성 실패는 치명적이지 않음 - 인라인 프롬프트로 진행하고 잠시 후 재시도
+                # (API 오류 자체는 생성 호출에서 표시)
+                cache = None
+                ttl_seconds = CONTEXT_CACHE_RETRY_AFTER.total_seconds()
+            cache_store[key] = {
+                'cache': cache,
+                'expires_at': time.time() + ttl_seconds
+            }
+            caches[actual_model_name] = cache
+    return caches
+
+
+def get_prompt_cache(api_key: str, actual_model_name: str, prompt: str) -> Optional[Any]:
+    """정적 프롬프트의 컨텍스트 캐시 조회/생성 (캐시 불가 시 None)"""
+    return get_prompt_caches(api_key, [actual_model_name], prompt)[actual_model_name]
+
+
+def make_response_cache_key(
     model_name: str,
     stats_content: str,
-    images: Optional[List[Any]],
-    prompt: str
+    prompt: str,
+    image_digests: List[str],
+    max_output_tokens: int
 ) -> str:
-    """AI API를 사용한 추론 실행"""
-
-    genai.configure(api_key=api_key)
-
-    generation_config = {
-        "temperature": 0.7,
-        "top_p": 0.95,
-        "top_k": 20,
-        "max_output_tokens": 86384,
+    """응답 캐시 키 생성 (통계 데이터 + 모델 + 프롬프트 + 출력 한도 + 그래프 해시)"""
+    parts = [
+        hashlib.sha256(stats_content.encode('utf-8')).hexdigest(),
+        MODEL_MAPPING.get(model_name, model_name),
+        hashlib.sha256(prompt.encode('utf-8')).hexdigest(),
+        # 한도를 올려 재시도하면 새로 생성되도록 출력 한도 포함
+        str(max_output_tokens),
+        # 그래프 번호가 보고서에 인용되므로 업로드 순서 유지
+        *image_digests
+    ]
+    return hashlib.sha256("\n".join(parts).encode('utf-8')).hexdigest()
+
+
+def load_cached_response(key: str) -> Optional[Tuple[str, str]]:
+    """디스크 캐시에서 (보고서, 생성 모델) 조회 (없거나 만료 시 None)"""
+    cache_path = RESPONSE_CACHE_DIR / f"{key}.json"
+    try:
+        if time.time() - cache_path.stat().st_mtime > RESPONSE_CACHE_TTL:
+            cache_path.unlink(missing_ok=True)
+            return None
+        cache_data = json.loads(cache_path.read_text(encoding='utf-8'))
+        return cache_data['report'], cache_data['model']
+    except (ValueError, KeyError):
+        # 손상된 항목은 삭제 후 재생성
+        cache_path.unlink(missing_ok=True)
+        return None
+    except OSError:
+        return None
+
+
+def prune_response_cache() -> None:
+    """만료된 디스크 캐시 파일 삭제 (중단된 쓰기의 임시 파일 포함)"""
+    now = time.time()
+    for path in RESPONSE_CACHE_DIR.iterdir():
+        try:
+            if now - path.stat().st_mtime > RESPONSE_CACHE_TTL:
+                path.unlink()
+        except OSError:
+            # 다른 세션이 먼저 삭제한 경우 등
+            pass
+
+
+def save_cached_response(key: str, model_name: str, report: str) -> None:
+    """생성된 보고서를 디스크 캐시에 저장 (실패 시 무시)"""
+    cache_data = {
+        "timestamp": datetime.now().isoformat(),
+        "model": model_name,
+        "report": report
     }
-
-    actual_model_name = MODEL_MAPPING.get(model_name, "gemini-2.5-flash")
-
-    model = genai.GenerativeModel(
-        model_name=actual_model_name,
-        generation_config=generation_config,
-        safety_settings={
-            'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE',
-            'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_NONE',
-            'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_NONE',
-            'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_NONE',
-        }
-    )
-
+    try:
+        RESPONSE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        prune_response_cache()
+        # 같은 디렉터리의 임시 파일에 쓴 뒤 교체 - 동시 저장/중단 시에도 잘린 JSON 없음
+        fd, tmp_path = tempfile.mkstemp(dir=RESPONSE_CACHE_DIR, prefix=f".{key}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(cache_data, f, ensure_ascii=False)
+            os.replace(tmp_path, RESPONSE_CACHE_DIR / f"{key}.json")
+        except OSError:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+    except OSError:
+        pass
+
+
+def build_model_input(stats_content: str, images: Optional[List[Any]]) -> List[Any]:
+    """프롬프트를 제외한 모델 입력 (통계 데이터 + 그래프) 구성"""
     model_input = [
-        prompt,
         "\n\n--- 분석 데이터 시작 ---\n",
         stats_content,
         "\n--- 분석 데이터 끝 ---\n",
@@ -510,82 +742,292 @@ def run_inference(
         model_input.append("\n--- 첨부 그래프 (10개) ---\n")
         model_input.extend(images)
 
-    response = model.generate_content(model_input)
+    return model_input
+
+
+def count_input_tokens(
+    model_name: str,
+    stats_content: str,
+    images: Optional[List[Any]],
+    prompt: str
+) -> int:
+    """생성 호출 전 입력 토큰 수 확인 (genai.configure 호출 후 사용)"""
+    import google.generativeai as genai
+
+    model = genai.GenerativeModel(MODEL_MAPPING.get(model_name, "gemini-2.5-flash"))
+    model_input = [prompt, *build_model_input(stats_content, images)]
+    return model.count_tokens(model_input).total_tokens
+
+
+def estimate_input_tokens(
+    stats_content: str,
+    images: Optional[List[Any]],
+    prompt: str
+) -> int:
+    """입력 토큰 수 상한 로컬 추정 (API 호출 없음)"""
+    return len(prompt) + len(stats_content) + IMAGE_TOKEN_ESTIMATE * len(images or [])
+
+
+def check_input_tokens(
+    model_name: str,
+    stats_content: str,
+    images: Optional[List[Any]],
+    prompt: str,
+    max_output_tokens: int
+) -> int:
+    """입력 토큰 한도 확인 - 로컬 추정이 한도에 근접할 때만 API로 계산 (초과 시 ValueError)"""
+    input_tokens = estimate_input_tokens(stats_content, images, prompt)
+    if input_tokens > MODEL_INPUT_TOKEN_LIMIT - max_output_tokens:
+        # 추정은 상한값이므로 실제 토큰 수로 재확인 (genai.configure 호출 후 사용)
+        input_tokens = count_input_tokens(model_name, stats_content, images, prompt)
+    if input_tokens > MODEL_INPUT_TOKEN_LIMIT - max_output_tokens:
+        raise ValueError(
+            f"입력 {input_tokens:,} 토큰이 모델 한도를 초과합니다. "
+            "'간략 분석'(텍스트만)으로 다시 시도하세요."
+        )
+    return input_tokens
+
+
+def build_model(actual_model_name: str, cache: Optional[Any] = None) -> Any:
+    """공통 생성 설정을 적용한 모델 인스턴스 생성 (cache 지정 시 캐시된 프롬프트 참조)"""
+    import google.generativeai as genai
+
+    if cache is not None:
+        return genai.GenerativeModel.from_cached_content(
+            cached_content=cache,
+            generation_config=GENERATION_CONFIG,
+            safety_settings=SAFETY_SETTINGS
+        )
+    return genai.GenerativeModel(
+        model_name=actual_model_name,
+        generation_config=GENERATION_CONFIG,
+        safety_settings=SAFETY_SETTINGS
+    )
+
+
+@st.cache_resource(show_spinner=False, max_entries=20)
+def get_model(
+    api_key: str,
+    actual_model_name: str,
+    cache_name: Optional[str] = None,
+    _cache: Optional[Any] = None
+) -> Any:
+    """API 키/모델/프롬프트 캐시별 모델 인스턴스 재사용 (재실행 간 공유)"""
+    # 모델은 첫 호출 시점의 전역 설정으로 클라이언트를 바인딩하므로 키를 먼저 설정
+    configure_genai(api_key)
+    return build_model(actual_model_name, _cache)
+
+
+def build_inference_input(
+    stats_content: str,
+    images: Optional[List[Any]],
+    prompt: str,
+    cache: Optional[Any]
+) -> List[Any]:
+    """요청 입력 구성 (캐시 사용 시 프롬프트는 캐시에서 참조 - 데이터와 그래프만 전송)"""
+    model_input = build_model_input(stats_content, images)
+    if cache is None:
+        model_input.insert(0, prompt)
+    return model_input
+
+
+def prepare_inference(
+    api_key: str,
+    model_name: str,
+    stats_content: str,
+    images: Optional[List[Any]],
+    prompt: str
+) -> tuple:
+    """모델 인스턴스와 입력 구성 (genai.configure 호출 후 사용)"""
+    actual_model_name = MODEL_MAPPING.get(model_name, "gemini-2.5-flash")
+    cache = get_prompt_cache(api_key, actual_model_name, prompt)
+    model = get_model(
+        api_key, actual_model_name,
+        cache.name if cache is not None else None, cache
+    )
+    return model, build_inference_input(stats_content, images, prompt, cache)
+
+
+def output_token_limit(model_name: str, max_output_tokens: int) -> int:
+    """보고서 출력 한도 + 모델별 사고 토큰 여유분 (모델 출력 한도 이내)"""
+    actual_model_name = MODEL_MAPPING.get(model_name, "gemini-2.5-flash")
+    reserve = THINKING_TOKEN_RESERVE.get(actual_model_name, 0)
+    return min(max_output_tokens + reserve, MODEL_OUTPUT_TOKEN_LIMIT)
+
+
+def check_finish_reason(finish_reason: Any, has_text: bool) -> None:
+    """응답 종료 사유 확인 - 잘리거나 빈 응답이면 IncompleteResponseError"""
+    # 중간 조각은 FINISH_REASON_UNSPECIFIED(0) - 마지막 조각에만 사유가 담김
+    reason = finish_reason.name if finish_reason else "STOP"
+    if reason == "MAX_TOKENS":
+        raise IncompleteResponseError(
+            "최대 출력 토큰 한도에 도달해 보고서가 잘렸습니다. "
+            "'고급 설정'에서 한도를 늘려 다시 시도하세요."
+        )
+    if reason != "STOP":
+        raise IncompleteResponseError(f"모델 응답이 중단되었습니다 (사유: {reason}).")
+    if not has_text:
+        raise IncompleteResponseError("모델이 빈 응답을 반환했습니다. 다시 시도하세요.")
+
+
+def run_inference_stream(
+    api_key: str,
+    model_name: str,
+    stats_content: str,
+    images: Optional[List[Any]],
+    prompt: str,
+    max_output_tokens: int
+) -> Iterator[str]:
+    """AI API를 사용한 스트리밍 추론 실행 (생성되는 대로 텍스트 조각 반환)"""
+
+    configure_genai(api_key)
+    model, model_input = prepare_inference(
+        api_key, model_name, stats_content, images, prompt
+    )
+
+    # 출력 한도는 요청마다 달라지므로 호출 단위로 지정 (모델 설정 위에 병합됨)
+    response = model.generate_content(
+        model_input,
+        generation_config={"max_output_tokens": output_token_limit(model_name, max_output_tokens)},
+        stream=True
+    )
+    finish_reason = None
+    has_text = False
+    for chunk in response:
+        if chunk.candidates and chunk.candidates[0].finish_reason:
+            finish_reason = chunk.candidates[0].finish_reason
+        # 종료 사유만 담긴 조각(토큰 한도 도달 등)은 텍스트 없음
+        if chunk.parts:
+            has_text = True
+            yield chunk.text
+    # 이미 표시된 조각은 남기고, 잘린 보고서는 완료/캐시 처리되지 않도록 예외 발생
+    check_finish_reason(finish_reason, has_text)
+
+
+async def run_inference_async(
+    model: Any,
+    model_input: List[Any],
+    model_name: str,
+    max_output_tokens: int
+) -> str:
+    """준비된 모델로 비동기 추론 실행 (genai.configure는 호출 측에서 1회 수행)"""
+    response = await model.generate_content_async(
+        model_input,
+        generation_config={"max_output_tokens": output_token_limit(model_name, max_output_tokens)}
+    )
+    candidate = response.candidates[0] if response.candidates else None
+    check_finish_reason(
+        candidate.finish_reason if candidate else None,
+        bool(candidate and candidate.content.parts)
+    )
     return response.text
 
 
+async def run_comparison(
+    api_key: str,
+    model_names: List[str],
+    stats_content: str,
+    images: Optional[List[Any]],
+    prompt: str,
+    max_output_tokens: int
+) -> List[Any]:
+    """여러 모델 동시 추론 - 소요 시간은 가장 느린 모델 기준 (실패 시 예외 객체 반환)"""
+    # 입력 토큰 한도 확인 (모델 공통 한도 - 1회만)
+    check_input_tokens(model_names[0], stats_content, images, prompt, max_output_tokens)
+
+    # 블로킹 준비(프롬프트 캐시 조회/생성)는 gather 전에 모델별로 동시에 완료
+    actual_model_names = [MODEL_MAPPING.get(name, "gemini-2.5-flash") for name in model_names]
+    caches = get_prompt_caches(api_key, actual_model_names, prompt)
+
+    requests = []
+    for name, actual_model_name in zip(model_names, actual_model_names):
+        cache = caches[actual_model_name]
+        # 비동기 클라이언트는 이벤트 루프에 묶이므로 asyncio.run마다 새 인스턴스 사용
+        requests.append(run_inference_async(
+            build_model(actual_model_name, cache),
+            build_inference_input(stats_content, images, prompt, cache),
+            name,
+            max_output_tokens
+        ))
+    return await asyncio.gather(*requests, return_exceptions=True)
+
+
 def main():
     initialize_session_state()
+    inject_css()
 
     # 헤더
-    col1, col2, col3 = st.columns([1, 2, 1])
-    with col2:
-        st.markdown("""
-            <div style='text-align: center'>
-                <h1>🏭 AM 공정 분석 도구</h1>
-                <p style='color: #7f8c8d; font-size: 1.1em'>
-                    통계 데이터 → 장인의 암묵지 v3.0
-                </p>
-            </div>
-        """, unsafe_allow_html=True)
+    render_header()
 
     st.markdown("---")
 
-    # 패키지 확인
-    missing = check_requirements()
+    # 패키지 확인 (세션당 1회)
+    if not st.session_state.get('_bootstrapped'):
+        st.session_state['_missing'] = check_requirements()
+        st.session_state['_bootstrapped'] = True
+    missing = st.session_state['_missing']
     if missing:
         st.error(f"필수 패키지 미설치: {', '.join(missing)}")
         st.code(f"pip install {' '.join(missing)}")
+        # 설치 안내에만 표시 - 이미지 디코딩/리샘플링 가속용 API 호환 대체 패키지
+        simd_hint = suggest_pillow_simd()
+        if simd_hint:
+            st.caption("x86_64 서버는 Pillow 대신 Pillow-SIMD 설치 시 그래프 처리가 빨라집니다:")
+            st.code(simd_hint)
         st.stop()
 
     # 사이드바 - API 설정 및 건강 상태 표시
     with st.sidebar:
         st.markdown("## API 설정")
 
-        api_key = st.text_input(
-            "API Key",
-            value=st.session_state.api_key,
-            type="password",
-            help="Google Generative AI API 키"
-        )
+        # 입력 중 재실행 방지 - API 키/모델은 '적용' 시에만 반영
+        with st.form("sidebar_config", border=False):
+            api_key = st.text_input(
+                "API Key",
+                value=st.session_state.api_key,
+                type="password",
+                help="Google Generative AI API 키"
+            )
+
+            model_name = st.selectbox(
+                "모델 선택",
+                options=list(MODEL_MAPPING.keys()),
+                index=1,
+                help="분석 복잡도에 따라 모델 선택"
+            )
+            st.session_state.model_name = model_name
+
+            st.form_submit_button("적용", use_container_width=True)
 
         if api_key:
             st.session_state.api_key = api_key
             st.success("API 키 설정됨")
 
-        model_name = st.selectbox(
-            "모델 선택",
-            options=list(MODEL_MAPPING.keys()),
-            index=1,
-            help="분석 복잡도에 따라 모델 선택"
-        )
-        st.session_state.model_name = model_name
-
         st.markdown("---")
 
         # 건강 상태 표시 (파싱된 경우)
         if st.session_state.parsed_health:
             health = st.session_state.parsed_health
             emoji, css_class, label, color = get_health_status_display(
-                health['overall_status'], health['health_score']
+                health.overall_status, health.health_score
             )
 
             st.markdown("### 공정 건강 상태")
             st.markdown(f"""
                 <div class='{css_class}'>
-                    <h2>{emoji} {health['overall_status']}</h2>
-                    <h3>점수: {health['health_score']:.2f}/1.00</h3>
+                    <h2>{emoji} {health.overall_status}</h2>
+                    <h3>점수: {health.health_score:.2f}/1.00</h3>
                 </div>
             """, unsafe_allow_html=True)
 
-            if health['critical_issues']:
+            if health.critical_issues:
                 st.error("**Critical Issues:**")
-                for issue in health['critical_issues']:
+                for issue in health.critical_issues:
                     st.markdown(f"- {issue}")
 
-            if health['warnings']:
+            if health.warnings:
                 st.warning("**Warnings:**")
-                for warn in health['warnings']:
+                for warn in health.warnings:
                     st.markdown(f"- {warn}")
 
         st.markdown("---")
@@ -619,30 +1061,36 @@ def main():
 
             if stats_file:
                 st.success(f"파일 업로드 완료: {stats_file.name}")
-                content = stats_file.read().decode('utf-8')
-                stats_file.seek(0)
 
-                # PROCESS_HEALTH 파싱
-                health_data = parse_process_health(content)
-                st.session_state.parsed_health = health_data
-
-                # ICA 정보 파싱
-                ica_data = parse_ica_info(content)
+                # 디코딩 + PROCESS_HEALTH/ICA 파싱 - 업로드 내용이 바뀐 경우에만 갱신
+                # (재실행마다 HealthReport 클래스가 재정의되어 인스턴스 비교는 항상 불일치)
+                raw_bytes = stats_file.getvalue()
+                report_digest = hashlib.sha1(raw_bytes).hexdigest()
+                if st.session_state.report_digest != report_digest:
+                    content, health_data, ica_data = load_report(raw_bytes)
+                    st.session_state.stats_content = content
+                    st.session_state.parsed_health = health_data
+                    st.session_state.parsed_health_dict = health_data.as_dict()
+                    st.session_state.parsed_ica = ica_data
+                    st.session_state.report_digest = report_digest
+                content = st.session_state.stats_content
+                health_data = st.session_state.parsed_health
+                ica_data = st.session_state.parsed_ica
 
                 # 파싱 결과 표시
                 with st.expander("📊 파싱된 건강 상태", expanded=True):
                     emoji, _, label, color = get_health_status_display(
-                        health_data['overall_status'], health_data['health_score']
+                        health_data.overall_status, health_data.health_score
                     )
 
                     cols = st.columns(3)
                     cols[0].metric("상태", f"{emoji} {label}")
-                    cols[1].metric("점수", f"{health_data['health_score']:.2f}")
-                    cols[2].metric("Mode1 에너지", f"{health_data['mode1_energy_pct']:.1f}%")
+                    cols[1].metric("점수", f"{health_data.health_score:.2f}")
+                    cols[2].metric("Mode1 에너지", f"{health_data.mode1_energy_pct:.1f}%")
 
                     cols2 = st.columns(2)
                     cols2[0].metric("ICA 문제 비율", f"{ica_data['problematic_ratio']:.0f}%")
-                    cols2[1].metric("에너지 집중", health_data['energy_concentration_status'])
+                    cols2[1].metric("에너지 집중", health_data.energy_concentration_status)
 
                 with st.expander("원본 파일 미리보기"):
                     st.text(content[:2000] + ("..." if len(content) > 2000 else ""))
@@ -663,13 +1111,13 @@ def main():
                         cols = st.columns(5)
                         for i, file in enumerate(graph_files[:5]):
                             with cols[i]:
-                                img = Image.open(file)
-                                st.image(img, caption=f"그래프 {i+1}", use_container_width=True)
+                                st.image(make_thumbnail(file), caption=f"그래프 {i+1}",
+                                         use_container_width=True)
                         cols = st.columns(5)
                         for i, file in enumerate(graph_files[5:10]):
                             with cols[i]:
-                                img = Image.open(file)
-                                st.image(img, caption=f"그래프 {i+6}", use_container_width=True)
+                                st.image(make_thumbnail(file), caption=f"그래프 {i+6}",
+                                         use_container_width=True)
                 else:
                     st.warning(f"10개 필요 (현재 {len(graph_files)}개)")
             else:
@@ -679,101 +1127,220 @@ def main():
     with tab2:
         st.markdown("### 분석 실행")
 
-        # 분석 유형 선택
+        # 분석 설정 - 옵션 변경마다 재실행하지 않고 생성 버튼 제출 시 일괄 반영
+        # 분석 유형 선택 - 준비 상태 표시가 바로 바뀌도록 폼 밖에 배치
         st.markdown("#### 분석 유형")
         analysis_type = st.radio(
             "분석 방식 선택",
             options=["full", "brief"],
             format_func=lambda x: "📊 전체 분석 (그래프 포함)" if x == "full" else "📝 간략 분석 (텍스트만)",
+            captions=[
+                "10개 그래프 + 통계 데이터로 상세 보고서 생성",
+                "텍스트 데이터만으로 핵심 내용 위주 보고서 생성"
+            ],
             horizontal=True
         )
         st.session_state.analysis_type = analysis_type
 
-        if analysis_type == "full":
-            st.info("10개 그래프 + 통계 데이터로 상세 보고서 생성")
-        else:
-            st.info("텍스트 데이터만으로 핵심 내용 위주 보고서 생성")
+        with st.form("analysis_config", border=False):
+            always_use_llm = st.checkbox(
+                "항상 AI 모델 사용",
+                value=False,
+                help=f"정상 공정(HEALTHY, 점수 ≥{HEALTHY_TEMPLATE_MIN_SCORE:.2f})도 "
+                     "정형 보고서 대신 모델로 분석"
+            )
 
-        st.markdown("---")
+            compare_models = st.checkbox(
+                "모델 비교",
+                value=False,
+                help="선택한 모델들로 동시에 보고서 생성 (소요 시간 ≈ 가장 느린 모델)"
+            )
+            compare_targets = st.multiselect(
+                "비교할 모델",
+                options=list(MODEL_MAPPING.keys()),
+                default=list(MODEL_MAPPING.keys()),
+                help="'모델 비교' 선택 시 사용"
+            )
 
-        # 입력 확인
-        col1, col2, col3 = st.columns(3)
-        with col1:
-            api_ready = bool(st.session_state.api_key)
-            st.metric("API 키", "✅" if api_ready else "❌")
-        with col2:
-            stats_ready = stats_file is not None
-            st.metric("통계 데이터", "✅" if stats_ready else "❌")
-        with col3:
-            if analysis_type == "full":
-                graphs_ready = graph_files and len(graph_files) == 10
-                st.metric("그래프", "✅ 10개" if graphs_ready else "❌")
-            else:
-                graphs_ready = True
-                st.metric("모드", "📝 간략")
+            with st.expander("고급 설정"):
+                force_refresh = st.checkbox(
+                    "강제 새로고침",
+                    value=False,
+                    help="캐시된 결과를 무시하고 모델을 다시 호출"
+                )
+                # 체크박스로 슬라이더를 토글할 수 없는 폼 안이므로 '기본값' 항목으로 대체
+                max_tokens_setting = st.select_slider(
+                    "최대 출력 토큰",
+                    options=["기본값", *range(1024, 65536 + 1, 1024)],
+                    value="기본값",
+                    format_func=lambda x: x if isinstance(x, str) else f"{x:,}",
+                    help=f"기본값: 전체 분석 {MAX_OUTPUT_TOKENS['full']:,} / "
+                         f"간략 분석 {MAX_OUTPUT_TOKENS['brief']:,}"
+                )
 
-        # 건강 상태 미리보기
-        if st.session_state.parsed_health:
-            health = st.session_state.parsed_health
-            emoji, css_class, label, _ = get_health_status_display(
-                health['overall_status'], health['health_score']
-            )
-            st.markdown(f"""
-                <div class='{css_class}' style='margin: 1rem 0;'>
-                    {emoji} 현재 공정 상태: <b>{health['overall_status']}</b>
-                    (점수: {health['health_score']:.2f})
-                </div>
-            """, unsafe_allow_html=True)
+            st.markdown("---")
 
-        st.markdown("---")
+            # 입력 확인
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                api_ready = bool(st.session_state.api_key)
+                st.metric("API 키", "✅" if api_ready else "❌")
+            with col2:
+                stats_ready = stats_file is not None
+                st.metric("통계 데이터", "✅" if stats_ready else "❌")
+            with col3:
+                if analysis_type == "full":
+                    graphs_ready = graph_files and len(graph_files) == 10
+                    st.metric("그래프", "✅ 10개" if graphs_ready else "❌")
+                else:
+                    graphs_ready = True
+                    st.metric("모드", "📝 간략")
+
+            # 건강 상태 미리보기
+            if st.session_state.parsed_health:
+                health = st.session_state.parsed_health
+                emoji, css_class, label, _ = get_health_status_display(
+                    health.overall_status, health.health_score
+                )
+                st.markdown(f"""
+                    <div class='{css_class}' style='margin: 1rem 0;'>
+                        {emoji} 현재 공정 상태: <b>{health.overall_status}</b>
+                        (점수: {health.health_score:.2f})
+                    </div>
+                """, unsafe_allow_html=True)
+
+            st.markdown("---")
+
+            # 실행 버튼 - 위 옵션은 제출 시 한 번에 반영
+            submitted = st.form_submit_button(
+                "🚀 분석 보고서 생성",
+                disabled=not (api_ready and stats_ready and graphs_ready),
+                use_container_width=True
+            )
+            st.caption(f"사용 모델: {st.session_state.model_name} (변경 시 사이드바 '적용')")
 
-        # 실행 버튼
-        if st.button("🚀 분석 보고서 생성",
-                    disabled=not (api_ready and stats_ready and graphs_ready),
-                    use_container_width=True):
+        if submitted:
 
             with st.spinner("분석 중... (최대 2-3분 소요)"):
                 try:
-                    stats_content = stats_file.read().decode('utf-8')
-                    stats_file.seek(0)
+                    stats_content = st.session_state.stats_content
 
                     images = None
                     if analysis_type == "full" and graph_files:
-                        images = []
-                        for file in graph_files:
-                            images.append(Image.open(file))
-                            file.seek(0)
-
-                    # 적절한 프롬프트 선택
-                    if analysis_type == "full" and images:
-                        use_prompt = AM_EXPERT_PROMPT
+                        # 긴 변 1024px 축소 + WEBP 인코딩으로 전송량/이미지 토큰 절감
+                        images = prepare_graph_images([file.getvalue() for file in graph_files])
+
+                    # 적절한 프롬프트 및 출력 토큰 한도 선택
+                    prompt_type = "full" if analysis_type == "full" and images else "brief"
+                    use_prompt = load_prompt(PROMPT_FILES[prompt_type])
+                    if max_tokens_setting != "기본값":
+                        max_output_tokens = max_tokens_setting
                     else:
-                        use_prompt = AM_BRIEF_EXPERT_PROMPT
-
-                    progress_bar = st.progress(0)
-                    progress_bar.progress(30, text="모델 초기화 중...")
+                        max_output_tokens = MAX_OUTPUT_TOKENS[prompt_type]
 
-                    result = run_inference(
-                        api_key=st.session_state.api_key,
-                        model_name=st.session_state.model_name,
-                        stats_content=stats_content,
-                        images=images,
-                        prompt=use_prompt
-                    )
+                    image_digests = []
+                    if images:
+                        image_digests = [hashlib.sha256(file.getvalue()).hexdigest()
+                                         for file in graph_files]
 
-                    progress_bar.progress(90, text="보고서 생성 중...")
+                    health = st.session_state.parsed_health
+                    if not always_use_llm and is_healthy_shortcut(health):
+                        result = render_healthy_template(health, st.session_state.parsed_ica)
+                        report_model = "템플릿"
+                        st.info("정상 공정으로 판정되어 정형 보고서 생성 (AI 모델 미호출)")
+                        st.session_state.comparison_reports = {}
+                    elif compare_models and compare_targets:
+                        reports = {}
+                        pending = []
+                        for name in compare_targets:
+                            key = make_response_cache_key(
+                                name, stats_content, use_prompt, image_digests,
+                                max_output_tokens
+                            )
+                            cached = None if force_refresh else load_cached_response(key)
+                            if cached is None:
+                                pending.append((name, key))
+                            else:
+                                reports[name] = cached[0]
+
+                        if pending:
+                            configure_genai(st.session_state.api_key)
+                            outputs = asyncio.run(run_comparison(
+                                api_key=st.session_state.api_key,
+                                model_names=[name for name, _ in pending],
+                                stats_content=stats_content,
+                                images=images,
+                                prompt=use_prompt,
+                                max_output_tokens=max_output_tokens
+                            ))
+                            for (name, key), output in zip(pending, outputs):
+                                if isinstance(output, IncompleteResponseError):
+                                    st.warning(f"{name}: {str(output)}")
+                                elif isinstance(output, Exception):
+                                    st.error(f"{name} 오류: {str(output)}")
+                                else:
+                                    save_cached_response(key, name, output)
+                                    reports[name] = output
+                            if not reports:
+                                raise outputs[0]
+
+                        reports = {name: reports[name] for name in compare_targets
+                                   if name in reports}
+                        # 선택 모델이 실패한 경우 첫 성공 모델의 보고서를 해당 모델 이름으로 표시
+                        report_model = (st.session_state.model_name
+                                        if st.session_state.model_name in reports
+                                        else next(iter(reports)))
+                        result = reports[report_model]
+                        st.session_state.comparison_reports = reports
+                    else:
+                        cache_key = make_response_cache_key(
+                            st.session_state.model_name, stats_content, use_prompt, image_digests,
+                            max_output_tokens
+                        )
+                        cached = None if force_refresh else load_cached_response(cache_key)
+                        if cached is None:
+                            # 생성 전 입력 토큰 확인 - 한도 초과 시 조기 중단
+                            configure_genai(st.session_state.api_key)
+                            run_model_name = st.session_state.model_name
+                            input_tokens = check_input_tokens(
+                                run_model_name, stats_content, images, use_prompt,
+                                max_output_tokens
+                            )
+                            # 상한 추정 기준이므로 확실히 작은 입력만 전환
+                            if prompt_type == "brief" and input_tokens < LITE_ROUTING_MAX_TOKENS:
+                                run_model_name = LITE_MODEL_NAME
+                                st.info(f"입력 약 {input_tokens:,} 토큰 이하 - 간략 분석은 "
+                                        f"{LITE_MODEL_NAME} 모델로 자동 전환")
+
+                            # 첫 토큰부터 화면에 표시
+                            result = st.write_stream(run_inference_stream(
+                                api_key=st.session_state.api_key,
+                                model_name=run_model_name,
+                                stats_content=stats_content,
+                                images=images,
+                                prompt=use_prompt,
+                                max_output_tokens=max_output_tokens
+                            ))
+                            save_cached_response(cache_key, run_model_name, result)
+                            report_model = run_model_name
+                        else:
+                            result, report_model = cached
+                            st.info("동일 입력의 캐시된 보고서 사용 (강제 새로고침으로 재생성 가능)")
+                        st.session_state.comparison_reports = {}
 
                     st.session_state.report_content = result
+                    st.session_state.report_model = report_model
+                    st.session_state.report_sections = split_report_sections(result)
                     st.session_state.report_generated = True
-
-                    progress_bar.progress(100, text="완료!")
-                    time.sleep(0.5)
-                    progress_bar.empty()
+                    st.session_state.report_timestamp = datetime.now()
 
                     st.success("보고서 생성 완료!")
                     st.balloons()
                     st.info("📄 '보고서 결과' 탭에서 확인하세요")
 
+                except IncompleteResponseError as e:
+                    # 잘린/빈 응답은 캐시에 저장하지 않고 보고서도 완료 처리하지 않음
+                    st.warning(str(e))
                 except Exception as e:
                     st.error(f"오류 발생: {str(e)}")
                     if "quota" in str(e).lower():
@@ -786,48 +1353,60 @@ def main():
         st.markdown("### 📄 생성된 보고서")
 
         if st.session_state.report_generated:
+            # 보고서 생성 시각 - 표시/파일명/헤더 모두 동일 시각 사용
+            report_ts = st.session_state.report_timestamp
+
             # 메타데이터
             col1, col2, col3 = st.columns(3)
             with col1:
-                st.metric("생성 시간", datetime.now().strftime("%Y-%m-%d %H:%M"))
+                st.metric("생성 시간", report_ts.strftime("%Y-%m-%d %H:%M"))
             with col2:
-                st.metric("사용 모델", st.session_state.model_name)
+                st.metric("사용 모델", st.session_state.report_model)
             with col3:
                 if st.session_state.parsed_health:
                     health = st.session_state.parsed_health
                     emoji, _, _, _ = get_health_status_display(
-                        health['overall_status'], health['health_score']
+                        health.overall_status, health.health_score
                     )
-                    st.metric("공정 상태", f"{emoji} {health['overall_status']}")
+                    st.metric("공정 상태", f"{emoji} {health.overall_status}")
 
             st.markdown("---")
 
-            # 보고서 내용
+            # 보고서 내용 - 첫 섹션만 바로 표시, 나머지는 펼칠 때 확인
+            sections = st.session_state.report_sections
             with st.container():
-                st.markdown(st.session_state.report_content)
+                if sections:
+                    st.markdown(sections[0])
+                for section in sections[1:]:
+                    title, _, body = section.partition("\n")
+                    with st.expander(title[3:].strip(), expanded=False):
+                        st.markdown(body)
+
+            # 모델 비교 결과
+            if len(st.session_state.comparison_reports) > 1:
+                st.markdown("---")
+                st.markdown("#### 모델별 보고서 비교")
+                compare_tabs = st.tabs(list(st.session_state.comparison_reports.keys()))
+                for compare_tab, report in zip(compare_tabs,
+                                               st.session_state.comparison_reports.values()):
+                    with compare_tab:
+                        st.markdown(report)
 
             # 다운로드 버튼
             st.markdown("---")
             col1, col2, col3 = st.columns(3)
 
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            timestamp = report_ts.strftime("%Y%m%d_%H%M%S")
 
             with col1:
-                # Markdown 파일
-                health_info = ""
-                if st.session_state.parsed_health:
-                    h = st.session_state.parsed_health
-                    health_info = f"\n**공정 상태:** {h['overall_status']} (점수: {h['health_score']:.2f})"
-
-                report_md = f"""# AM 공정 분석 보고서
-
-**생성 시간:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-**사용 모델:** {st.session_state.model_name}
-**분석 유형:** {'전체 분석' if st.session_state.analysis_type == 'full' else '간략 분석'}{health_info}
-
----
-
-{st.session_state.report_content}"""
+                # Markdown 파일 (보고서 생성 시각 기준으로 캐시)
+                report_md = build_report_md(
+                    report_content=st.session_state.report_content,
+                    timestamp=report_ts.strftime('%Y-%m-%d %H:%M:%S'),
+                    model_name=st.session_state.report_model,
+                    analysis_type=st.session_state.analysis_type,
+                    process_health=st.session_state.parsed_health_dict
+                )
 
                 st.download_button(
                     label="📥 Markdown 다운로드",
@@ -838,18 +1417,18 @@ def main():
                 )
 
             with col2:
-                # JSON 파일
-                json_data = {
-                    "timestamp": datetime.now().isoformat(),
-                    "model": st.session_state.model_name,
-                    "analysis_type": st.session_state.analysis_type,
-                    "process_health": st.session_state.parsed_health,
-                    "report": st.session_state.report_content
-                }
+                # JSON 파일 (보고서 생성 시각 기준으로 캐시)
+                report_json = build_report_json(
+                    report_content=st.session_state.report_content,
+                    timestamp=report_ts.isoformat(),
+                    model_name=st.session_state.report_model,
+                    analysis_type=st.session_state.analysis_type,
+                    process_health=st.session_state.parsed_health_dict
+                )
 
                 st.download_button(
                     label="📥 JSON 다운로드",
-                    data=json.dumps(json_data, ensure_ascii=False, indent=2),
+                    data=report_json,
                     file_name=f"AM_Report_{timestamp}.json",
                     mime="application/json",
                     use_container_width=True
@@ -859,7 +1438,14 @@ def main():
                 if st.button("🔄 새 분석", use_container_width=True):
                     st.session_state.report_generated = False
                     st.session_state.report_content = ""
+                    st.session_state.report_sections = []
+                    st.session_state.report_model = ""
+                    st.session_state.report_timestamp = None
                     st.session_state.parsed_health = None
+                    st.session_state.parsed_health_dict = None
+                    st.session_state.parsed_ica = None
+                    st.session_state.report_digest = None
+                    st.session_state.comparison_reports = {}
                     st.rerun()
         else:
             st.info("📊 분석을 실행하면 여기에 보고서가 표시됩니다")